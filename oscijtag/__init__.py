@@ -8,25 +8,44 @@ https://github.com/eblot/pyftdi/blob/master/pyftdi/tests/jtag.py
 
 This module defines several free-functions which execute common RISC-V JTAG commands, 
 such as `read_dtmcontrol`, `bypass`, and `read_idcode`. 
-More direct access to the underlying `pyftdi.JtagEngine` is avalable via the module-level `jtag` attribute. 
+More direct access to the underlying `pyftdi.JtagEngine` is avalable via `get_jtag`, or the equivalent module-level `jtag` attribute. 
+Either connects to the adapter on first use; importing the module performs no hardware access. 
 
 This module is designed to be used as a library for larger test programs and scripts. 
 Quick tests of its installation and associated hardware setup are available via its `check_connection` function, as in: 
 ```shell
-python -c "import oscijtag; oscijtag.check_connection()"
+python -c "import logging, oscijtag; logging.basicConfig(level=logging.INFO); oscijtag.check_connection()"
 ```
 The `check_connection` method is also recommended to be run early in such test-programs. 
 
+Commands track the instruction register value they last wrote, and skip rewriting it where unchanged, 
+e.g. across a series of `read_dmi(..., flush=False)` calls. 
+The tracked value is discarded whenever the TAP is found outside of `update_ir` or `update_dr`, where these commands leave it, 
+e.g. after `jtag.reset()`. Callers which otherwise change the IR directly via `jtag` must follow up with `forget_ir`. 
+
+Progress and results are reported via the `oscijtag` logger: `check_connection` at `INFO` level, 
+and the individual JTAG commands at `DEBUG` level. 
+
 """
 
 __version__ = "0.1.0"
 
+import logging
+import os
+import queue
+import threading
+from collections import deque
 from dataclasses import dataclass, asdict
-from typing import Optional, Tuple, Union
+from functools import lru_cache
+from typing import Callable, Deque, List, Optional, Tuple, Union
 from types import SimpleNamespace
 
-from pyftdi.jtag import JtagEngine, JtagTool
+from pyftdi.ftdi import Ftdi
+from pyftdi.jtag import JtagEngine, JtagError, JtagStateMachine, JtagTool
 from pyftdi.bits import BitSequence
+from pyftdi.usbtools import UsbToolsError
+
+log = logging.getLogger(__name__)
 
 
 @dataclass
@@ -39,6 +58,9 @@ class FtdiUsbJtagDeviceInfo:
     Note these field-names correspond to the arguments to `ftdi.open_mpsse`, 
     used below to create a connection. """
 
+    # Explicit `__slots__`, rather than `dataclass(slots=True)`, which requires Python 3.10
+    __slots__ = ("vendor", "product", "interface")
+
     vendor: int  # Vendor ID
     product: int  # Product ID
     interface: int  # Interface number (usually 1)
@@ -51,24 +73,147 @@ class FtdiUsbJtagDeviceInfo:
 # A: FTDI provide drivers and instructions at their web site, download them and use our ARM-USB-TINY-H PID: 0x002a, VID: 0x15BA to install the drivers.
 OlimexArmJtag = FtdiUsbJtagDeviceInfo(product=0x002A, vendor=0x15BA, interface=1)
 
-# Create the Jtag Engine
-# The `trst=True` option has been observed to be important, although it's not clear why it should be.
-jtag = JtagEngine(trst=True, frequency=1e5)
+# The FTDI latency timer sets how long the adapter holds partially-filled read-packets before returning them to the host.
+# Nearly all of our transfers are far shorter than a USB packet, and would otherwise each wait out `pyftdi`'s 16ms default.
+FTDI_LATENCY_MS = 1
+
+# Default USB transfer and MPSSE command-batch chunk size, in bytes, overridable via the `OSCIJTAG_CHUNKSIZE` environment variable.
+# Zero (the default) uses the adapter's FIFO sizes, which keeps its bulk endpoints full between transfers.
+# Non-zero values are capped to the FIFO sizes, and must be at least `FTDI_CHUNKSIZE_MIN`.
+FTDI_CHUNKSIZE = 0
+
+# Minimum non-zero chunk size: the USB full-speed packet size, and comfortably larger than any single fixed-width command.
+FTDI_CHUNKSIZE_MIN = 64
+
+# Default JTAG TCK frequency, in Hz, overridable via the `OSCIJTAG_FREQUENCY` environment variable.
+# Note `JtagEngine`'s own `frequency` argument only takes effect via its URL-based `configure`, which we bypass,
+# so this is instead passed to `open_mpsse` directly. The ARM-USB-TINY-H's FT2232H supports up to 30MHz.
+JTAG_FREQUENCY = 6e6
+
+# Frequency attempted by `check_connection`, when `OSCIJTAG_FREQUENCY` is not set
+JTAG_FREQUENCY_RAMP = 15e6
+
+# Maximum TCK frequency supported by the FT2232H
+JTAG_FREQUENCY_MAX = 30e6
+
+
+@dataclass(frozen=True)
+class _Settings:
+    """ Settings overridable via environment variables. 
+    Parsed on connecting, by `get_jtag`, rather than at import, so that malformed values cannot break the import. """
+
+    frequency: float  # TCK frequency, per `OSCIJTAG_FREQUENCY`, else `JTAG_FREQUENCY`
+    chunksize: int  # Chunk size, per `OSCIJTAG_CHUNKSIZE`, else `FTDI_CHUNKSIZE`
+    ramp: bool  # Whether `check_connection` ramps TCK, i.e. whether `OSCIJTAG_FREQUENCY` is unset
+
+
+@lru_cache(maxsize=None)
+def _settings() -> _Settings:
+    """ Get the `_Settings`, parsing them from the environment on first call. 
+    Raises a `ValueError` naming any malformed variable. Failures are not cached. """
+    return _Settings(
+        frequency=_parse_env("OSCIJTAG_FREQUENCY", _parse_frequency, JTAG_FREQUENCY, f"a float in (0, {JTAG_FREQUENCY_MAX:.0f}]"),
+        chunksize=_parse_env("OSCIJTAG_CHUNKSIZE", _parse_chunksize, FTDI_CHUNKSIZE, f"0 or an int >= {FTDI_CHUNKSIZE_MIN}"),
+        ramp="OSCIJTAG_FREQUENCY" not in os.environ,
+    )
+
+
+def _parse_env(name: str, parse: Callable, default, expected: Optional[str] = None):
+    """ Parse environment variable `name` via `parse`, or return `default` if it is unset. 
+    Errors describe the `expected` value, by default the name of `parse`. """
+    text = os.environ.get(name)
+    if text is None:
+        return default
+    try:
+        return parse(text)
+    except ValueError:
+        raise ValueError(f"Invalid {name} environment variable {text!r}: expected {expected or parse.__name__}") from None
+
+
+def _parse_frequency(text: str) -> float:
+    """ Parse a TCK frequency, rejecting non-finite values, and those outside of (0, `JTAG_FREQUENCY_MAX`]. """
+    frequency = float(text)
+    # Written such that NaN fails the comparison
+    if not 0 < frequency <= JTAG_FREQUENCY_MAX:
+        raise ValueError(frequency)
+    return frequency
+
+
+def _parse_chunksize(text: str) -> int:
+    """ Parse a chunk size, rejecting non-zero values below `FTDI_CHUNKSIZE_MIN`, including negative values. """
+    chunksize = int(text)
+    if chunksize != 0 and chunksize < FTDI_CHUNKSIZE_MIN:
+        raise ValueError(chunksize)
+    return chunksize
 
-# Configuring the adapter requires reaching a few levels into `jtag`, rather than using `pyftdi`'s default URL scheme.
-jtag.controller.ftdi.open_mpsse(**asdict(OlimexArmJtag))
+
+@lru_cache(maxsize=None)
+def get_jtag() -> JtagEngine:
+    """ Get the module's `JtagEngine`, creating it and connecting to the adapter on first call. 
+    No USB traffic occurs at import time; it is deferred until this is first called, 
+    either directly, via the module-level `jtag` attribute, or by any of the JTAG commands below. 
+
+    Raises a `JtagError` if the adapter cannot be opened, e.g. if it is not plugged in, 
+    or a `ValueError` if an `OSCIJTAG_*` environment variable is malformed. 
+    Failures are not cached, so a later call retries from scratch. """
+
+    frequency = _settings().frequency
+
+    # Create the Jtag Engine
+    # The `trst=True` option has been observed to be important, although it's not clear why it should be.
+    jtag = JtagEngine(trst=True, frequency=frequency)
+
+    try:
+        # Configuring the adapter requires reaching a few levels into `jtag`, rather than using `pyftdi`'s default URL scheme.
+        ftdi = jtag.controller.ftdi
+        ftdi.open_mpsse(**asdict(OlimexArmJtag), frequency=frequency, latency=FTDI_LATENCY_MS)
+
+        txsize, rxsize = _chunk_sizes(ftdi)
+        ftdi.write_data_set_chunksize(txsize)
+        ftdi.read_data_set_chunksize(rxsize)
+
+        # Pulse nTRST once up-front. Beyond resetting the TAP, this is also what first configures the adapter's GPIO directions,
+        # which the batched commands below, whose TAP resets are TMS-only, rely upon.
+        jtag.reset()
+    except Exception as err:
+        # Release the device if it was opened, so that it is not held busy against the next attempt
+        jtag.close()
+        if isinstance(err, (OSError, ValueError, UsbToolsError, JtagError)):
+            raise JtagError(f"Unable to open JTAG adapter {OlimexArmJtag}: {err}") from err
+        raise
+
+    return jtag
+
+
+def _chunk_sizes(ftdi: Ftdi) -> Tuple[int, int]:
+    """ (TX, RX) chunk sizes, per the configured chunk size and the FIFO sizes of `ftdi`. """
+    txsize, rxsize = ftdi.fifo_sizes
+    chunksize = _settings().chunksize
+    if chunksize:
+        return min(txsize, chunksize), min(rxsize, chunksize)
+    return txsize, rxsize
+
+
+def __getattr__(name: str):
+    """ Module-level attribute hook (PEP 562), creating the `jtag` attribute on first access. """
+    if name == "jtag":
+        return get_jtag()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 """
 # RISC-V Jtag Registers
 Taps spelled out by the RISC-V Debug Spec 
 """
+# BYPASS is also available at reserved addresses 0x12 through 0x1F
+BYPASS_IR = BitSequence("00000", msb=True, length=5)
+IDCODE_IR = BitSequence("00001", msb=True, length=5)
+DTMCS_IR = BitSequence("10000", msb=True, length=5)
+DMI_IR = BitSequence("10001", msb=True, length=5)
+
+# Namespace of the same registers, retained for existing users
 RiscvJtagRegs = SimpleNamespace(
-    # BYPASS is also available at reserved addresses 0x12 through 0x1F
-    BYPASS=BitSequence("00000", msb=True, length=5),
-    IDCODE=BitSequence("00001", msb=True, length=5),
-    DTMCS=BitSequence("10000", msb=True, length=5),
-    DMI=BitSequence("10001", msb=True, length=5),
+    BYPASS=BYPASS_IR, IDCODE=IDCODE_IR, DTMCS=DTMCS_IR, DMI=DMI_IR,
 )
 
 
@@ -82,12 +227,230 @@ JtagIdCodes = {
 }
 
 
+# Fixed data-register inputs, built once at import rather than on each call.
+# Shared by reference; callers must not mutate them.
+_BYPASS_DEFAULT = BitSequence("011011110000" * 2, length=24)
+_BYPASS_EXPECTED = int(_BYPASS_DEFAULT)
+
+
+"""
+# MPSSE Command Batches
+
+For sequences of operations whose inputs are known up-front, the TAP moves and register shifts 
+are instead encoded directly as MPSSE commands, queued into an `_MpsseBatch`, 
+and written to the adapter in as few USB transfers as its FIFOs allow - a single one, for all but bulk transfers. 
+The batch records the width of each queued DR shift, so that the concatenated response can be split back apart. 
+
+The tracked IR and TAP FSM state are updated as commands are queued, ahead of their execution. 
+Batches are therefore built within a `with` block, which discards the tracked IR, via `forget_ir`, 
+if anything raises before the batch is successfully executed. 
+"""
+
+
+class _MpsseBatch:
+    """ Queue of raw MPSSE commands, and the bit-widths of the DR shifts they read back. 
+    Commands are grouped into chunks sized per `OSCIJTAG_CHUNKSIZE`, by default to fit the adapter's TX and RX FIFOs, 
+    each written in a single USB transfer. """
+
+    def __init__(self):
+        self.txsize, self.rxsize = _chunk_sizes(get_jtag().controller.ftdi)
+        self.chunks: List[bytearray] = [bytearray()]
+        self.nreads: List[int] = [0]  # Bytes read back by each chunk
+        self.widths: List[int] = []
+
+    def __enter__(self) -> "_MpsseBatch":
+        return self
+
+    def __exit__(self, exc_type, *_) -> None:
+        if exc_type is not None:
+            # Commands queued thus far have updated the tracked IR and TAP state, but never reached the TAP
+            forget_ir()
+
+    def add(self, cmd: bytes, nread: int = 0) -> None:
+        """ Queue command `cmd`, which reads back `nread` bytes. """
+        # Leave room for each chunk's trailing `SEND_IMMEDIATE`.
+        # Commands larger than a whole chunk get one to themselves, rather than leaving an empty chunk ahead of them.
+        if self.chunks[-1] and (
+            len(self.chunks[-1]) + len(cmd) >= self.txsize
+            or self.nreads[-1] + nread > self.rxsize
+        ):
+            self.chunks.append(bytearray())
+            self.nreads.append(0)
+        self.chunks[-1] += cmd
+        self.nreads[-1] += nread
+
+    def execute(self) -> List[bytes]:
+        """ Write all queued commands, one transfer per chunk, and read back the result of each queued DR shift. 
+        Results are little-endian `bytes`, padded to a whole number of bytes. """
+        jtag = get_jtag()
+        ftdi = jtag.controller.ftdi
+        # Flush anything already stacked on the controller, to keep commands in order
+        jtag.sync()
+
+        resp = bytearray()
+        try:
+            for chunk, nread in zip(self.chunks, self.nreads):
+                ftdi.write_data(chunk + bytes((Ftdi.SEND_IMMEDIATE,)))
+                if nread:
+                    data = ftdi.read_data_bytes(nread, 4)
+                    if len(data) != nread:
+                        raise JtagError(f"Read {len(data)} of {nread} bytes from FTDI")
+                    resp += data
+        except Exception:
+            # The TAP may be left anywhere. Have the next command reset it and rewrite the IR.
+            forget_ir()
+            # Drop any response bytes arriving late, which would otherwise be read back as those of later commands.
+            # Should the adapter have gone away, this fails too; report the original error instead.
+            try:
+                ftdi.purge_rx_buffer()
+            except Exception:
+                log.warning("Failed to purge the FTDI RX buffer", exc_info=True)
+            raise
+
+        rv = []
+        pos = 0
+        for width in self.widths:
+            n = _shift_response_len(width)
+            rv.append(_decode_shift_response(bytes(resp[pos : pos + n]), width))
+            pos += n
+        return rv
+
+
+def _shift_response_len(width: int) -> int:
+    """ Number of bytes returned by the adapter for a `width`-bit DR shift, as queued by `_build_shift_dr`. """
+    nbytes, nbits = divmod(width - 1, 8)
+    return nbytes + bool(nbits) + 1
+
+
+def _decode_shift_response(resp: bytes, width: int) -> bytes:
+    """ Reassemble the `width`-bit register value from its `_shift_response_len(width)` response bytes, 
+    into `ceil(width / 8)` little-endian bytes. """
+    nbytes, nbits = divmod(width - 1, 8)
+    # Bit-mode reads shift in from the MSB
+    tail = resp[nbytes] >> (8 - nbits) if nbits else 0
+    # The final bit is clocked out alongside the first TMS bit of the exit to `update_dr`
+    tail |= ((resp[-1] >> 6) & 0x1) << nbits
+    return resp[:nbytes] + bytes((tail,))
+
+
+# Stand-alone TAP FSM, used only for path-finding between states
+_TAP_FSM = JtagStateMachine()
+
+# TMS-based TAP reset, from any state
+_TMS_RESET = bytes((Ftdi.WRITE_BITS_TMS_NVE, 4, 0x1F))
+
+# TMS events exiting from `shift_dr` to `update_dr`
+_TMS_EXIT_SHIFT = BitSequence("11")
+
+
+@lru_cache(maxsize=None)
+def _tms_path(source: str, target: str) -> Tuple[bytes, BitSequence]:
+    """ MPSSE command moving the TAP FSM from state `source` to `target`, and the TMS events it comprises. 
+    Computed once per pair, as every command here traverses the same handful of paths. 
+    The command holds TDI low; see `_build_tms`. """
+    events = _TAP_FSM.get_events(_TAP_FSM.find_path(target, source))
+    return bytes((Ftdi.WRITE_BITS_TMS_NVE, len(events) - 1, events.tobyte())), events
+
+
+def _build_tms(batch: _MpsseBatch, statename: str, tdi: int = 0) -> None:
+    """ Queue the TMS sequence to move to `statename`, holding TDI at `tdi`. """
+    jtag = get_jtag()
+    sm = jtag.state_machine
+    cmd, events = _tms_path(sm.state().name, statename)
+    if tdi:
+        cmd = cmd[:2] + bytes((cmd[2] | 0x80,))
+    batch.add(cmd)
+    sm.handle_events(events)
+
+
+def _build_reset(batch: _MpsseBatch) -> None:
+    """ Queue a TMS-based reset of the TAP FSM. Unlike `jtag.reset()`, this does not pulse nTRST. """
+    jtag = get_jtag()
+    batch.add(_TMS_RESET)
+    jtag.state_machine.reset()
+    forget_ir()
+
+
+# The instruction register value last queued by `_ensure_ir`, or `None` if unknown.
+# An unknown IR also marks the tracked TAP FSM state as untrusted, e.g. after a failed transfer.
+_current_ir: Optional[BitSequence] = None
+
+# TAP FSM states in which the commands here leave the TAP. The tracked IR is only trusted in these.
+_IR_TRACKED_STATES = ("update_ir", "update_dr")
+
+
+def forget_ir() -> None:
+    """ Discard the tracked instruction register value, so that the next command resets the TAP and rewrites the IR. 
+    Required after changing the IR directly via `jtag`. """
+    global _current_ir
+    _current_ir = None
+
+
+def _ensure_ir(batch: _MpsseBatch, instruction: BitSequence) -> None:
+    """ Queue a write of the instruction register, unless it already holds `instruction`. 
+    If the IR is unknown, first queues a reset of the TAP FSM. 
+    Leaves the TAP FSM in `update_ir` if written, or wherever it was if not. """
+    global _current_ir
+    if _current_ir is not None and get_jtag().state_machine.state().name not in _IR_TRACKED_STATES:
+        # The TAP has been moved elsewhere, e.g. reset, via `jtag` directly
+        _current_ir = None
+    if _current_ir is not None and _current_ir == instruction:
+        return
+    if _current_ir is None:
+        _build_reset(batch)
+    _build_write_ir(batch, instruction)
+    _current_ir = instruction
+
+
+def _build_write_ir(batch: _MpsseBatch, instruction: BitSequence) -> None:
+    """ Queue a write of the instruction register, leaving the TAP FSM in `update_ir`. """
+    _build_tms(batch, "shift_ir")
+    # All but the last bit are shifted in `shift_ir`, the last on the exit from it
+    nbits = len(instruction) - 1
+    batch.add(bytes((Ftdi.WRITE_BITS_NVE_LSB, nbits - 1, instruction[:nbits].tobyte())))
+    _build_tms(batch, "update_ir", tdi=int(instruction[nbits]))
+
+
+def _build_shift_dr(batch: _MpsseBatch, val: int, width: int) -> None:
+    """ Queue a shift of the low `width` bits of integer `val` into the data register, reading back its prior contents. 
+    Values are packed into the MPSSE payload directly via `int.to_bytes`, rather than bit-by-bit through a `BitSequence`. 
+    Requires the TAP FSM be in `shift_dr`, and leaves it in `update_dr`. """
+    jtag = get_jtag()
+    nbytes, nbits = divmod(width - 1, 8)
+    pos = 8 * nbytes
+    if nbytes:
+        blen = nbytes - 1
+        cmd = bytes((Ftdi.RW_BYTES_PVE_NVE_LSB, blen & 0xFF, (blen >> 8) & 0xFF))
+        batch.add(cmd + (val & ((1 << pos) - 1)).to_bytes(nbytes, "little"), nbytes)
+    if nbits:
+        batch.add(bytes((Ftdi.RW_BITS_PVE_NVE_LSB, nbits - 1, (val >> pos) & ((1 << nbits) - 1))), 1)
+    # Exit to `update_dr`, shifting the last bit on the first TMS clock
+    last = (val >> (width - 1)) & 0x1
+    batch.add(bytes((Ftdi.RW_BITS_TMS_PVE_NVE, 1, _TMS_EXIT_SHIFT.tobyte() | (last << 7))), 1)
+    jtag.state_machine.handle_events(_TMS_EXIT_SHIFT)
+    batch.widths.append(width)
+
+
+def _execute_one(builder: Callable[..., object], *args, flush: bool) -> bytes:
+    """ Execute the single-DR-shift command queued by `builder(batch, *args)`, followed by a TAP reset if `flush`. 
+    Returns the result of its DR shift, as for `_MpsseBatch.execute`. Any value returned by `builder` is discarded. """
+    with _MpsseBatch() as batch:
+        builder(batch, *args)
+        if flush:
+            _build_reset(batch)
+        (buf,) = batch.execute()
+    return buf
+
+
 def detect_irlen() -> int:
     """ Auto-detect the instruction register length"""
+    jtag = get_jtag()
 
     # Create the `JtagTool`, a self-described "helper class with facility functions".
     tool = JtagTool(jtag)
 
+    # These bypass the tracked IR. Discard it up-front, so that it remains unknown should any of them fail.
+    forget_ir()
     jtag.reset()
     jtag.go_idle()
     jtag.capture_ir()
@@ -101,62 +464,69 @@ def detect_irlen() -> int:
     return irlen
 
 
-def read_idcode(from_reset: bool = True) -> int:
+def read_idcode(from_reset: bool = True, flush: bool = True) -> int:
     """ Read the default data-register, IDCODE. 
     Check for existence in our know-good values dict. 
     Returns the integer id-code read, and leaves the JTAG TAP in its reset state.  
 
     Boolean argument `from_reset` indicates whether to send the `IDCODE` IR, 
-    or to read the DR directly from the default/ reset state (which should be the IDCODE). """
+    or to read the DR directly from the default/ reset state (which should be the IDCODE). 
+    If `flush` is false, the trailing TAP reset is skipped, and the TAP is left in `update_dr`. """
 
-    jtag.reset()
-    if not from_reset:
-        jtag.write_ir(RiscvJtagRegs.IDCODE)
-    idcode = jtag.read_dr(32)
-    idcode = int(idcode)
+    # The IR write, DR shift, and trailing reset are all queued into a single MPSSE command stream
+    buf = _execute_one(_build_read_idcode, from_reset, flush=flush)
+
+    idcode = int.from_bytes(buf, "little")
+    _check_idcode(idcode)
+    return idcode
 
+
+def _check_idcode(idcode: int) -> None:
+    """ Check for `idcode` in our known-good values dict. """
     if idcode not in JtagIdCodes:
         raise ValueError(f"Unknown IDCODE: 0x{idcode:x}")
-    print(f"Detected the IDCODE for {JtagIdCodes[idcode]}")
-
-    jtag.reset()
-    return idcode
+    log.debug("Detected the IDCODE for %s", JtagIdCodes[idcode])
 
 
-def bypass(inp: Optional[BitSequence] = None) -> BitSequence:
+def bypass(inp: Optional[BitSequence] = None, flush: bool = True) -> BitSequence:
     """ Move into BYPASS, send `inp`, and check for equality with what comes back. 
     Returns the resultant `BitSequence` shifted out of the device. Leaves the JTAG TAP in its reset state. 
     Note the output is shifted one bit by this function, so should be directly comparable to `inp`. 
-    If no `inp` is provided, one is created internally. """
+    If no `inp` is provided, a default is used. 
+    If `flush` is false, the trailing TAP reset is skipped, and the TAP is left in `update_dr`. """
 
-    if inp is None:  # Create some default data
-        inp = BitSequence("011011110000" * 2, length=24)
+    if inp is None:  # Use the default data
+        inp = _BYPASS_DEFAULT
+    buf = _execute_one(_build_bypass, inp, flush=flush)
 
-    # Reset the TAP FSM
-    jtag.reset()
+    out = int.from_bytes(buf, "little")
+    _check_bypass(inp, out)
 
-    # Write the instruction register
-    jtag.write_ir(RiscvJtagRegs.BYPASS)
+    # Shift the returned output by one bit, to be comparable to `inp`
+    return BitSequence(out >> 1, length=len(inp))
 
-    # Move to shift in data, first via run-test-idle.
-    jtag.go_idle()
-    jtag.change_state("shift_dr")
-    out = jtag.shift_and_update_register(inp)
 
-    # Shift the output left by one bit for comparison
-    out.lsr(1)
-    if out != inp:
-        raise ValueError(f"Bypass failed: {inp} vs {out}")
-    print(f"Bypass check passed, sent and received {out}")
+def _check_bypass(inp: BitSequence, out: int) -> None:
+    """ Check that `out`, the integer value shifted out of BYPASS, matches `inp`. """
+    expected = _BYPASS_EXPECTED if inp is _BYPASS_DEFAULT else int(inp)
+    # BYPASS delays by one bit; shift the output right by one for comparison
+    received = out >> 1
+    if received != expected:
+        raise ValueError(f"Bypass failed: sent 0x{expected:x}, received 0x{received:x}")
+    log.debug("Bypass check passed, sent and received 0x%x", received)
 
-    jtag.reset()
-    return out
+
+# Reserved `dtmcontrol` bits, which must read as zero: bit 15, and bits 18 and up.
+# Equal to 0xFFFC_8000 for the 32-bit register.
+_DTMCS_RESERVED_MASK = ~0x3_7FFF
 
 
 @dataclass
 class DtmControlValue:
     """ Field-Decoded `dtmcontrol` Register Value """
 
+    __slots__ = ("version", "abits", "dmistat", "idle", "dmireset", "dmihardreset")
+
     version: int
     abits: int
     dmistat: int
@@ -167,14 +537,19 @@ class DtmControlValue:
     @classmethod
     def from_bitseq(cls, bitseq: BitSequence) -> "DtmControlValue":
         """ Decode from a `BitSequence` """
-        val = int(bitseq)
+        return cls.from_int(int(bitseq))
+
+    @classmethod
+    def from_bytes(cls, buf: bytes) -> "DtmControlValue":
+        """ Decode from little-endian `bytes`, as returned by `_MpsseBatch.execute` """
+        return cls.from_int(int.from_bytes(buf, "little"))
+
+    @classmethod
+    def from_int(cls, val: int) -> "DtmControlValue":
+        """ Decode from an integer register value """
 
-        if (val >> 15) & 0x1 != 0:
-            msg = f"Invalid DTMCONTROL bit 15 high value, should be hard-coded low "
-            raise ValueError(msg)
-        if (val >> 18) != 0:
-            msg = f"Invalid DTMCONTROL bits 18-31: {val >> 18}, should be zero "
-            raise ValueError(msg)
+        if val & _DTMCS_RESERVED_MASK:
+            raise ValueError(f"Invalid DTMCONTROL reserved bits: 0x{val:x}")
 
         return DtmControlValue(
             version=val & 0x0F,  # Bottom 4 bits
@@ -186,31 +561,34 @@ class DtmControlValue:
         )
 
 
-def read_dtmcontrol() -> Tuple[int, DtmControlValue]:
-    """ Read the `dtmcs` (AKA `dtmcontrol`) register. Returns its integer and decoded values. """
+def read_dtmcontrol(flush: bool = True) -> Tuple[int, DtmControlValue]:
+    """ Read the `dtmcs` (AKA `dtmcontrol`) register. Returns its integer and decoded values. 
+    If `flush` is false, the trailing TAP reset is skipped, and the TAP is left in `update_dr`. """
 
-    # Reset the TAP FSM
-    jtag.reset()
-    # Write the instruction register
-    jtag.write_ir(RiscvJtagRegs.DTMCS)
-
-    # Move to shift in data, first via run-test-idle.
-    jtag.go_idle()
-    jtag.change_state("shift_dr")
-    inp = BitSequence(0, length=32)
-    out = jtag.shift_and_update_register(inp)
+    buf = _execute_one(_build_read_dtmcontrol, flush=flush)
 
     # Decode and return what comes back
-    rv = int(out), DtmControlValue.from_bitseq(out)
-    print(f"Read DtmControl: {hex(rv[0])} => {rv[1]}")
-
-    jtag.reset()
+    rv = int.from_bytes(buf, "little"), DtmControlValue.from_bytes(buf)
+    log.debug("Read DtmControl: 0x%x => %s", rv[0], rv[1])
     return rv
 
 
-@dataclass
+def read_dtmcontrol_abits(flush: bool = True) -> int:
+    """ Read the `abits` field of `dtmcontrol`. 
+    A fast path for callers which need only `abits`, skipping the full decode and validation of `read_dtmcontrol`. """
+
+    buf = _execute_one(_build_read_dtmcontrol, flush=flush)
+    return (int.from_bytes(buf, "little") >> 4) & 0x3F
+
+
+@dataclass(frozen=True)
 class DmiValue:
-    """ Field-Decoded `dmi` Register Value """
+    """ Field-Decoded `dmi` Register Value. 
+    Frozen, so that its packed integer encoding can be computed once, on construction. """
+
+    # Slot `_packed_int` holds the integer encoding of the register fields.
+    # (`functools.cached_property` would require a per-instance `__dict__`.)
+    __slots__ = ("len", "address", "data", "op", "_packed_int")
 
     # Register length
     len: int
@@ -220,105 +598,319 @@ class DmiValue:
     data: int
     op: int
 
+    def __post_init__(self):
+        packed = (self.op & 0x03) | ((self.data << 2) & 0x3_FFFF_FFFC) | (self.address << 34)
+        # Bypass the frozen-dataclass `__setattr__`
+        object.__setattr__(self, "_packed_int", packed)
+
+    # Pickling (and hence `copy`) support. With `__slots__` and no `__dict__`, the default restores each slot
+    # via `setattr`, which the frozen dataclass rejects. (`dataclass(slots=True)` generates equivalents.)
+    def __getstate__(self) -> tuple:
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state: tuple) -> None:
+        for name, value in zip(self.__slots__, state):
+            object.__setattr__(self, name, value)
+
     def to_bitseq(self) -> BitSequence:
         """ Encode to a `BitSequence` """
-        val = (
-            (self.op & 0x03) | ((self.data << 2) & 0x3_FFFF_FFFC) | (self.address << 34)
-        )
-        return BitSequence(val, length=self.len)
+        return BitSequence(self._packed_int, length=self.len)
 
     @classmethod
     def from_bitseq(cls, bitseq: BitSequence) -> "DmiValue":
         """ Decode from a `BitSequence`. Length is kept identical to that of `bitseq`. """
-        val = int(bitseq)
+        return cls.from_int(int(bitseq), len(bitseq))
+
+    @classmethod
+    def from_bytes(cls, buf: bytes, length: int) -> "DmiValue":
+        """ Decode from little-endian `bytes`, as returned by `_MpsseBatch.execute`. 
+        The register length `length` is required, as `buf` is padded to a whole number of bytes. """
+        return cls.from_int(int.from_bytes(buf, "little"), length)
+
+    @classmethod
+    def from_int(cls, val: int, length: int) -> "DmiValue":
+        """ Decode from an integer register value of width `length` """
 
         return DmiValue(
-            len=len(bitseq),
+            len=length,
             op=val & 0x03,  # Bottom 2 bits
             data=(val >> 2) & 0xFFFF_FFFF,  # 32 bits
             address=val >> 34,  # Remaining `abits` bits
         )
 
 
-def read_dmi(abits: int) -> Tuple[int, DmiValue]:
+def read_dmi(abits: int, flush: bool = True) -> Tuple[int, DmiValue]:
     """ Read the `dmi` Debug-Module Inteface register. 
-    DMI is of width `33 + abits`, where `abits` is the address-bits field read from `dtmcontrol`. """
+    DMI is of width `33 + abits`, where `abits` is the address-bits field read from `dtmcontrol`. 
+    If `flush` is false, the trailing TAP reset is skipped, and the TAP is left in `update_dr`. """
 
-    # Reset the TAP FSM
-    jtag.reset()
-    # Write the instruction register
-    jtag.write_ir(RiscvJtagRegs.DMI)
-
-    # Move to shift in data, first via run-test-idle.
-    jtag.go_idle()
-    jtag.change_state("shift_dr")
-    inp = BitSequence(0, length=abits + 33)
-    out = jtag.shift_and_update_register(inp)
+    buf = _execute_one(_build_read_dmi, abits, flush=flush)
 
     # Decode and return what comes back
-    rv = int(out), DmiValue.from_bitseq(out)
-    print(f"Read Dmi: {hex(rv[0])} => {rv[1]}")
-
-    jtag.reset()
+    rv = int.from_bytes(buf, "little"), DmiValue.from_bytes(buf, abits + 33)
+    log.debug("Read Dmi: 0x%x => %s", rv[0], rv[1])
     return rv
 
 
-def write_dmi(data: Union[DmiValue, BitSequence]) -> Tuple[int, DmiValue]:
-    """ Write the `dmi` Debug-Module Inteface register. 
-    Sends input of `data`'s width, which must equal that of `dmi` for writes to succeed. """
+def read_dmi_op(abits: int, flush: bool = True) -> int:
+    """ Read the `op` (status) field of `dmi`, e.g. for polling for completion of a prior request. 
+    A fast path for callers which need only `op`, skipping the full decode of `read_dmi`. """
 
-    # Reset the TAP FSM
-    jtag.reset()
-    # Write the instruction register
-    jtag.write_ir(RiscvJtagRegs.DMI)
+    buf = _execute_one(_build_read_dmi, abits, flush=flush)
+    # `op` is the bottom two bits
+    return buf[0] & 0x03
 
-    # Move to shift in data, first via run-test-idle.
-    jtag.go_idle()
-    jtag.change_state("shift_dr")
 
+def _dmi_input(data: Union[DmiValue, BitSequence]) -> Tuple[int, int]:
+    """ Integer value and bit-width of `dmi` input `data`. """
     if isinstance(data, DmiValue):
-        data = data.to_bitseq()
-    out = jtag.shift_and_update_register(data)
+        return data._packed_int, data.len
+    return int(data), len(data)
+
+
+def write_dmi(data: Union[DmiValue, BitSequence], flush: bool = True) -> Tuple[int, DmiValue]:
+    """ Write the `dmi` Debug-Module Inteface register. 
+    Sends input of `data`'s width, which must equal that of `dmi` for writes to succeed. 
+    If `flush` is false, the trailing TAP reset is skipped, and the TAP is left in `update_dr`. """
+
+    val, width = _dmi_input(data)
+
+    buf = _execute_one(_build_write_dmi, val, width, flush=flush)
 
     # Decode and return what comes back
-    rv = int(out), DmiValue.from_bitseq(out)
-    print(f"Wrote Dmi, Got Back: {hex(rv[0])} => {rv[1]}")
+    rv = int.from_bytes(buf, "little"), DmiValue.from_bytes(buf, width)
+    log.debug("Wrote Dmi, Got Back: 0x%x => %s", rv[0], rv[1])
+    return rv
 
-    jtag.reset()
+
+def write_dmi_many(
+    values: List[Union[DmiValue, BitSequence]], flush: bool = True
+) -> List[Tuple[int, DmiValue]]:
+    """ Write each of `values`, in order, to the `dmi` Debug-Module Inteface register. 
+    Unlike repeated calls to `write_dmi`, the IR is written once, with no TAP resets between writes, 
+    and all DR shifts are queued into a single `_MpsseBatch`. 
+    Returns the integer and decoded values shifted out by each write. 
+    If `flush` is false, the trailing TAP reset is skipped, and the TAP is left in `update_dr`. """
+
+    with _MpsseBatch() as batch:
+        for value in values:
+            # Only the first write's `_ensure_ir` writes the IR
+            _build_write_dmi(batch, *_dmi_input(value))
+        if flush:
+            _build_reset(batch)
+        bufs = batch.execute()
+
+    # Decode and return what comes back
+    rv = []
+    for width, buf in zip(batch.widths, bufs):
+        rv.append((int.from_bytes(buf, "little"), DmiValue.from_bytes(buf, width)))
+    log.debug("Wrote %d Dmi values", len(rv))
     return rv
 
 
+class DmiPipeline:
+    """ # DMI Pipeline
+
+    Pipelined access to the `dmi` Debug-Module Interface register. 
+    Values passed to `submit` are shifted into `dmi` by a background thread, one USB transfer each, 
+    while the calling thread decodes the results of earlier shifts via `result`. 
+    The IR is written once, when the pipeline is created. 
+
+    At most `depth` submitted values are held awaiting the adapter; `submit` blocks beyond that. 
+    Results are returned by `result` in submission order. 
+    No other JTAG commands may be issued while a pipeline is open. 
+
+    Typical usage: 
+    ```python
+    with DmiPipeline() as pipe:
+        for value in values:
+            pipe.submit(value)
+        results = [pipe.result() for _ in values]
+    ```
+    """
+
+    def __init__(self, depth: int = 4, flush: bool = True):
+        # Whether to reset the TAP on `close`
+        self.flush = flush
+        self._requests: queue.Queue = queue.Queue(maxsize=depth)
+        self._results: queue.Queue = queue.Queue()
+        self._lengths: Deque[int] = deque()  # Register lengths of outstanding requests
+        self._error: Optional[Exception] = None  # First error encountered by the background thread
+
+        # Write the instruction register, once up-front
+        with _MpsseBatch() as batch:
+            _ensure_ir(batch, DMI_IR)
+            batch.execute()
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, data: Union[DmiValue, BitSequence]) -> None:
+        """ Queue a shift of `data` into `dmi`. Its result is later available via `result`. """
+        val, width = _dmi_input(data)
+        # The TAP FSM is tracked here, in the calling thread, in submission order.
+        # The IR is already written, so `_ensure_ir` queues nothing further.
+        with _MpsseBatch() as batch:
+            _build_write_dmi(batch, val, width)
+        self._lengths.append(width)
+        self._requests.put(batch)
+
+    def result(self) -> Tuple[int, DmiValue]:
+        """ Get the integer and decoded values shifted out by the oldest outstanding `submit`. 
+        Blocks until available. Re-raises any error encountered communicating with the adapter. """
+        buf = self._results.get()
+        length = self._lengths.popleft()
+        if isinstance(buf, Exception):
+            raise buf
+        return int.from_bytes(buf, "little"), DmiValue.from_bytes(buf, length)
+
+    def close(self) -> None:
+        """ Wait for all submitted shifts to complete, and stop the background thread. """
+        self._requests.put(None)
+        self._thread.join()
+        if self._error is not None:
+            # Requests submitted after the failure were tracked by `submit`, but never reached the TAP
+            forget_ir()
+        if self.flush:
+            with _MpsseBatch() as batch:
+                _build_reset(batch)
+                batch.execute()
+
+    def __enter__(self) -> "DmiPipeline":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def _run(self) -> None:
+        """ Background thread: execute each queued request, in order, until receiving the `None` sentinel. """
+        while True:
+            batch = self._requests.get()
+            if batch is None:
+                return
+            if self._error is not None:
+                # Once one transfer has failed, the TAP state is unknown. Fail all that follow.
+                self._results.put(self._error)
+                continue
+            try:
+                (buf,) = batch.execute()
+            except Exception as err:
+                self._error = err
+                self._results.put(err)
+            else:
+                self._results.put(buf)
+
+
+"""
+# Batched Operations
+
+Builder-variants of `read_idcode`, `bypass`, `read_dtmcontrol`, `read_dmi` and `write_dmi`, 
+which queue the operation onto an `_MpsseBatch` rather than executing it. 
+Each starts from wherever the prior command left the TAP, only resetting it and rewriting the IR where required; see `_ensure_ir`. 
+Each queues exactly one DR shift, and hence contributes one entry to the result of `_MpsseBatch.execute`. 
+"""
+
+
+def _build_read_idcode(batch: _MpsseBatch, from_reset: bool = True) -> None:
+    """ Queue a read of IDCODE. Argument `from_reset` is as for `read_idcode`. """
+    if from_reset:
+        _build_reset(batch)
+    else:
+        _ensure_ir(batch, IDCODE_IR)
+    _build_tms(batch, "shift_dr")
+    _build_shift_dr(batch, 0, 32)
+
+
+def _build_bypass(batch: _MpsseBatch, inp: Optional[BitSequence] = None) -> BitSequence:
+    """ Queue a shift of `inp` through BYPASS. Returns `inp`, or the default used if not provided. """
+    if inp is None:  # Use the default data
+        inp = _BYPASS_DEFAULT
+    _ensure_ir(batch, BYPASS_IR)
+    _build_tms(batch, "run_test_idle")
+    _build_tms(batch, "shift_dr")
+    _build_shift_dr(batch, int(inp), len(inp))
+    return inp
+
+
+def _build_read_dtmcontrol(batch: _MpsseBatch) -> None:
+    """ Queue a read of `dtmcontrol`. """
+    _ensure_ir(batch, DTMCS_IR)
+    _build_tms(batch, "run_test_idle")
+    _build_tms(batch, "shift_dr")
+    _build_shift_dr(batch, 0, 32)
+
+
+def _build_read_dmi(batch: _MpsseBatch, abits: int) -> None:
+    """ Queue a read of `dmi`, of width `33 + abits`. """
+    _build_write_dmi(batch, 0, abits + 33)
+
+
+def _build_write_dmi(batch: _MpsseBatch, val: int, width: int) -> None:
+    """ Queue a write of the `width`-bit integer `val` to `dmi`. """
+    _ensure_ir(batch, DMI_IR)
+    _build_tms(batch, "run_test_idle")
+    _build_tms(batch, "shift_dr")
+    _build_shift_dr(batch, val, width)
+
+
+def ramp_frequency(frequency: float) -> float:
+    """ Attempt to raise the TCK frequency to `frequency`, verified by reading back a known-good IDCODE. 
+    Falls back to the configured frequency on failure. Returns the resultant (actual) TCK frequency. """
+
+    ftdi = get_jtag().controller.ftdi
+    fallback = _settings().frequency
+    actual = ftdi.set_frequency(frequency)
+    try:
+        read_idcode()
+    except (ValueError, JtagError):
+        log.warning("IDCODE check failed at %.0f Hz, falling back to %.0f Hz", actual, fallback)
+        actual = ftdi.set_frequency(fallback)
+    return actual
+
+
 def check_connection():
     """ Check for a valid connection. 
     Typically to be performed at startup, before attempting MMIOs and other more elaborate commands. """
 
-    print("Checking Connection")
+    log.info("Checking Connection")
 
-    print("Detecting IR Length")
+    log.info("Detecting IR Length")
     detect_irlen()
 
-    print("Reading the reset-value data-register (IDCODE)")
-    read_idcode(from_reset=True)
+    if _settings().ramp:
+        log.info("Ramping TCK to %.0f Hz", JTAG_FREQUENCY_RAMP)
+        ramp_frequency(JTAG_FREQUENCY_RAMP)
 
-    print("Reading IDCODE")
-    read_idcode(from_reset=False)
+    # Everything up to DMI has fixed width, and is queued into a single MPSSE command stream.
+    # DMI's width depends on the `abits` read from DTMCONTROL, and is read separately.
+    with _MpsseBatch() as batch:
+        _build_read_idcode(batch, from_reset=True)
+        _build_read_idcode(batch, from_reset=False)
+        bypass_inp = _build_bypass(batch)
+        _build_read_dtmcontrol(batch)
+        _build_reset(batch)
+        (reset_idcode, idcode, bypass_out, dtmcs) = batch.execute()
 
-    print("Testing BYPASS")
-    bypass(inp=None)
+    log.info("Reading the reset-value data-register (IDCODE)")
+    _check_idcode(int.from_bytes(reset_idcode, "little"))
 
-    print("Reading DTMCONTROL")
-    (_, dtmctrl) = read_dtmcontrol()
+    log.info("Reading IDCODE")
+    _check_idcode(int.from_bytes(idcode, "little"))
 
-    print("Reading DMI")
+    log.info("Testing BYPASS")
+    _check_bypass(bypass_inp, int.from_bytes(bypass_out, "little"))
+
+    log.info("Reading DTMCONTROL")
+    dtmctrl = DtmControlValue.from_bytes(dtmcs)
+    log.info("Read DtmControl: 0x%x => %s", int.from_bytes(dtmcs, "little"), dtmctrl)
+
+    log.info("Reading DMI")
     read_dmi(dtmctrl.abits)
 
     # Make a (thus far nonsensical) debug-module request via `dmi`
     # dmival = DmiValue(len=33 + dtmctrl.abits, op=1, data=0xFFFF_FFFF, address=0x7F,)
     # write_dmi(dmival)
 
-    print("Connection Checks Succeeded")
-
+    log.info("Connection Checks Succeeded")
 
-# Run connection tests at import time. Requires hardware be in place for this module to be imported.
-# check_connection()
 
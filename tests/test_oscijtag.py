@@ -1,5 +1,401 @@
-from oscijtag import __version__
+import copy
+import pathlib
+import pickle
+import subprocess
+import sys
+
+import pytest
+
+from pyftdi.bits import BitSequence
+from pyftdi.ftdi import Ftdi
+from pyftdi.jtag import JtagEngine, JtagError
+
+import oscijtag
+from oscijtag import __version__, DmiValue, DtmControlValue
+
+
+class FakeFtdi:
+    """ Stand-in for `pyftdi.ftdi.Ftdi`, recording all writes and replaying canned read data from `rx`. """
+
+    is_connected = True
+
+    def __init__(self):
+        self.fifo_sizes = (4096, 4096)
+        self.writes = []
+        self.reads = []
+        self.rx = bytearray()
+        self.purged = 0
+
+    @property
+    def out(self) -> bytes:
+        return b"".join(self.writes)
+
+    def write_data(self, data):
+        self.writes.append(bytes(data))
+        return len(data)
+
+    def read_data_bytes(self, size, attempt=1):
+        self.reads.append(size)
+        data = bytes(self.rx[:size])
+        del self.rx[:size]
+        return data
+
+    def purge_rx_buffer(self):
+        self.purged += 1
+
+
+@pytest.fixture
+def ftdi(monkeypatch):
+    """ A `FakeFtdi`, installed beneath the module's `JtagEngine`, available as its `engine` attribute. """
+    engine = JtagEngine(trst=True)
+    fake = FakeFtdi()
+    fake.engine = engine
+    engine.controller._ftdi = fake
+    monkeypatch.setattr(oscijtag, "get_jtag", lambda: engine)
+    oscijtag.forget_ir()
+    yield fake
+    oscijtag.forget_ir()
+
+
+def _shift_response(val, width):
+    """ Bytes returned by the adapter for a `width`-bit DR shift, shifting out `val`. """
+    nbytes, nbits = divmod(width - 1, 8)
+    resp = bytearray((val & ((1 << 8 * nbytes) - 1)).to_bytes(nbytes, "little"))
+    if nbits:
+        # Bit-mode reads shift in from the MSB
+        resp.append(((val >> 8 * nbytes) & ((1 << nbits) - 1)) << (8 - nbits))
+    # The final bit is read alongside the first TMS bit
+    resp.append(((val >> (width - 1)) & 0x1) << 6)
+    return bytes(resp)
 
 
 def test_version():
     assert __version__ == '0.1.0'
+
+
+def test_dtmcontrol_from_bytes():
+    # version=1, abits=7, dmistat=0, idle=5
+    dtmctrl = DtmControlValue.from_bytes((0x5071).to_bytes(4, "little"))
+    assert dtmctrl == DtmControlValue(
+        version=1, abits=7, dmistat=0, idle=5, dmireset=0, dmihardreset=0
+    )
+
+
+@pytest.mark.parametrize("val", [1 << 15, 1 << 18, 1 << 31])
+def test_dtmcontrol_reserved_bits(val):
+    with pytest.raises(ValueError):
+        DtmControlValue.from_int(0x71 | val)
+
+
+def test_dmi_from_bytes():
+    dmi = DmiValue(len=40, address=0x11, data=0xDEAD_BEEF, op=2)
+    buf = int(dmi.to_bitseq()).to_bytes(5, "little")
+    assert DmiValue.from_bytes(buf, 40) == dmi
+
+
+@pytest.mark.parametrize("dup", [copy.copy, copy.deepcopy, lambda v: pickle.loads(pickle.dumps(v))])
+def test_dmi_copy(dup):
+    dmi = DmiValue(len=40, address=0x11, data=0xDEAD_BEEF, op=2)
+    other = dup(dmi)
+    assert other == dmi
+    assert other._packed_int == dmi._packed_int
+
+
+@pytest.mark.parametrize("width", [2, 8, 9, 32, 33, 40, 99])
+def test_shift_dr_matches_pyftdi(ftdi, width):
+    val = int.from_bytes(bytes(range(0x11, 0x11 + 13)), "little") % (1 << width)
+    # Arbitrary response bytes, including bits which each decoder must discard
+    resp = bytes(range(0xA5, 0xA5 + oscijtag._shift_response_len(width)))
+    engine = ftdi.engine
+
+    engine.change_state("shift_dr")
+    ftdi.writes.clear()
+    ftdi.rx[:] = resp
+    expected = engine.shift_and_update_register(BitSequence(val, length=width))
+    expected_cmds = ftdi.out
+
+    engine.change_state("shift_dr")
+    ftdi.writes.clear()
+    ftdi.rx[:] = resp
+    batch = oscijtag._MpsseBatch()
+    oscijtag._build_shift_dr(batch, val, width)
+    (buf,) = batch.execute()
+
+    assert ftdi.out == expected_cmds + bytes((Ftdi.SEND_IMMEDIATE,))
+    assert int.from_bytes(buf, "little") == int(expected)
+    assert engine.state_machine.state().name == "update_dr"
+
+
+@pytest.mark.parametrize("val", [0, 1])
+def test_shift_dr_single_bit(ftdi, val):
+    # Too short for `pyftdi`, which cannot shift zero bits ahead of the TMS exit
+    ftdi.engine.change_state("shift_dr")
+    ftdi.writes.clear()
+    ftdi.rx[:] = _shift_response(val, 1)
+    batch = oscijtag._MpsseBatch()
+    oscijtag._build_shift_dr(batch, val, 1)
+    (buf,) = batch.execute()
+    assert ftdi.out == bytes((Ftdi.RW_BITS_TMS_PVE_NVE, 1, 0x03 | (val << 7), Ftdi.SEND_IMMEDIATE))
+    assert buf == bytes((val,))
+
+
+@pytest.mark.parametrize("instruction", [oscijtag.IDCODE_IR, oscijtag.DTMCS_IR, oscijtag.DMI_IR])
+def test_write_ir_matches_pyftdi(ftdi, instruction):
+    engine = ftdi.engine
+    engine.write_ir(instruction)
+    expected_cmds = ftdi.out
+
+    engine.change_state("test_logic_reset")
+    ftdi.writes.clear()
+    batch = oscijtag._MpsseBatch()
+    oscijtag._build_write_ir(batch, instruction)
+    batch.execute()
+
+    assert ftdi.out == expected_cmds + bytes((Ftdi.SEND_IMMEDIATE,))
+    assert engine.state_machine.state().name == "update_ir"
+
+
+@pytest.mark.parametrize("width", [1, 2, 8, 9, 32, 33, 40, 99])
+def test_decode_shift_response(width):
+    val = int.from_bytes(bytes(range(0x11, 0x11 + 13)), "little") % (1 << width)
+    resp = _shift_response(val, width)
+    assert len(resp) == oscijtag._shift_response_len(width)
+    assert oscijtag._decode_shift_response(resp, width) == val.to_bytes((width + 7) // 8, "little")
+
+
+def test_batch_chunks(ftdi):
+    ftdi.fifo_sizes = (8, 4)
+    batch = oscijtag._MpsseBatch()
+    for _ in range(5):
+        batch.add(bytes(3))
+    for _ in range(3):
+        batch.add(bytes(1), 3)
+    # Each chunk leaves room for its trailing `SEND_IMMEDIATE`
+    assert [len(chunk) for chunk in batch.chunks] == [6, 6, 4, 1, 1]
+    assert batch.nreads == [0, 0, 3, 3, 3]
+
+    ftdi.rx[:] = bytes(9)
+    assert batch.execute() == []
+    assert [len(w) for w in ftdi.writes] == [7, 7, 5, 2, 2]
+    assert all(w[-1] == Ftdi.SEND_IMMEDIATE for w in ftdi.writes)
+    assert ftdi.reads == [3, 3, 3]
+
+
+def test_batch_oversized_command(ftdi):
+    ftdi.fifo_sizes = (8, 4)
+    batch = oscijtag._MpsseBatch()
+    batch.add(bytes(10), 6)
+    batch.add(bytes(3))
+    assert [len(chunk) for chunk in batch.chunks] == [10, 3]
+    assert batch.nreads == [6, 0]
+
+
+def test_batch_chunked_results(ftdi):
+    # Small enough to split every DR shift into its own chunk
+    ftdi.fifo_sizes = (32, 8)
+    values = [DmiValue(len=40, address=i, data=0x1000 + i, op=1) for i in range(4)]
+    for value in values:
+        ftdi.rx += _shift_response(value._packed_int, 40)
+
+    results = oscijtag.write_dmi_many(values)
+
+    assert [dmi for _, dmi in results] == values
+    assert all(len(w) <= 32 for w in ftdi.writes)
+    assert all(n <= 8 for n in ftdi.reads)
+
+
+def test_batch_short_read(ftdi):
+    ftdi.rx[:] = bytes(2)
+    with pytest.raises(JtagError):
+        oscijtag.read_dmi(7)
+    assert ftdi.purged == 1
+    assert oscijtag._current_ir is None
+
+
+def test_batch_failed_purge(ftdi, monkeypatch):
+    def purge_rx_buffer():
+        raise OSError("device gone")
+
+    monkeypatch.setattr(ftdi, "purge_rx_buffer", purge_rx_buffer)
+    ftdi.rx[:] = bytes(2)
+    # The short read is reported, rather than the failed purge
+    with pytest.raises(JtagError):
+        oscijtag.read_dmi(7)
+    assert oscijtag._current_ir is None
+
+
+@pytest.fixture
+def built(monkeypatch):
+    """ Log of the IR writes, TAP resets and DR shifts subsequently queued. """
+    log = []
+    for name, tag in [("_build_write_ir", "ir"), ("_build_reset", "reset"), ("_build_shift_dr", "shift")]:
+        func = getattr(oscijtag, name)
+
+        def wrapper(*args, func=func, tag=tag):
+            log.append(tag)
+            return func(*args)
+
+        monkeypatch.setattr(oscijtag, name, wrapper)
+    return log
+
+
+def test_write_dmi_many(ftdi, built):
+    values = [
+        DmiValue(len=40, address=1, data=0xDEAD_BEEF, op=2),
+        BitSequence(0x12_3456_7891, length=40),
+        DmiValue(len=40, address=3, data=0x1234_5678, op=1),
+    ]
+    outs = [0x11_1111_1111, 0x22_2222_2222, 0x33_3333_3333]
+    for out in outs:
+        ftdi.rx += _shift_response(out, 40)
+
+    results = oscijtag.write_dmi_many(values, flush=False)
+
+    # One IR write, preceded by the reset of the until-then unknown TAP, and no resets between values
+    assert built == ["reset", "ir", "shift", "shift", "shift"]
+    assert [val for val, _ in results] == outs
+    assert [dmi for _, dmi in results] == [DmiValue.from_int(out, 40) for out in outs]
+    assert ftdi.engine.state_machine.state().name == "update_dr"
+
+
+def test_dmi_pipeline_order(ftdi, built):
+    values = [DmiValue(len=40, address=i, data=0x100 * i, op=1) for i in range(6)]
+    outs = [DmiValue(len=40, address=i, data=0xF00D + i, op=0) for i in range(6)]
+    for out in outs:
+        ftdi.rx += _shift_response(out._packed_int, 40)
+
+    with oscijtag.DmiPipeline(depth=2) as pipe:
+        for value in values:
+            pipe.submit(value)
+        results = [pipe.result() for _ in values]
+
+    assert [dmi for _, dmi in results] == outs
+    assert built == ["reset", "ir"] + ["shift"] * len(values) + ["reset"]
+
+
+@pytest.mark.parametrize("flush", [True, False])
+def test_dmi_pipeline_error(ftdi, built, flush):
+    value = DmiValue(len=40, address=1, data=2, op=1)
+    # Enough response data for only the first shift
+    ftdi.rx += _shift_response(0, 40)
+
+    with oscijtag.DmiPipeline(flush=flush) as pipe:
+        for _ in range(2):
+            pipe.submit(value)
+        assert pipe.result() == (0, DmiValue(len=40, address=0, data=0, op=0))
+        with pytest.raises(JtagError):
+            pipe.result()
+        # Submitted after the failure, and hence skipped
+        pipe.submit(value)
+        with pytest.raises(JtagError):
+            pipe.result()
+    # Only the failed transfer itself reached the adapter
+    assert ftdi.reads == [6, 6]
+
+    # The next command must not trust the IR tracked by the skipped submissions
+    built.clear()
+    ftdi.rx += _shift_response(0, 40)
+    oscijtag.read_dmi(7)
+    assert built == ["reset", "ir", "shift", "reset"]
+
+
+@pytest.mark.parametrize("flush", [True, False])
+def test_dmi_pipeline_close(ftdi, flush):
+    pipe = oscijtag.DmiPipeline(flush=flush)
+    ftdi.writes.clear()
+    pipe.close()
+    assert ftdi.writes == ([oscijtag._TMS_RESET + bytes((Ftdi.SEND_IMMEDIATE,))] if flush else [])
+
+
+def test_failed_build_forgets_ir(ftdi, built):
+    value = DmiValue(len=40, address=1, data=2, op=1)
+    ftdi.rx += _shift_response(0, 40)
+    oscijtag.write_dmi(value)
+
+    # Fails while queueing its second value, after having queued the IR write and move to `shift_dr`
+    ftdi.writes.clear()
+    with pytest.raises(TypeError):
+        oscijtag.write_dmi_many([value, None])
+    assert ftdi.writes == []
+
+    # The next command must not trust the tracked IR or TAP state
+    built.clear()
+    ftdi.rx += _shift_response(0, 40)
+    oscijtag.write_dmi(value)
+    assert built == ["reset", "ir", "shift", "reset"]
+
+
+@pytest.mark.parametrize("move", [lambda engine: engine.reset(), lambda engine: engine.go_idle()])
+def test_direct_tap_move_forgets_ir(ftdi, built, move):
+    ftdi.rx += _shift_response(0, 40)
+    oscijtag.read_dmi(7, flush=False)
+
+    # Moves the TAP out from under the tracked IR, without calling `forget_ir`
+    move(ftdi.engine)
+
+    built.clear()
+    ftdi.rx += _shift_response(0, 40)
+    oscijtag.read_dmi(7)
+    assert built == ["reset", "ir", "shift", "reset"]
+
+
+@pytest.mark.parametrize("error, raised", [(OSError, JtagError), (ZeroDivisionError, ZeroDivisionError)])
+def test_open_failure_closes(monkeypatch, error, raised):
+    closed = []
+
+    def open_mpsse(self, **kwargs):
+        # Fails after having claimed the device
+        raise error("open failed")
+
+    monkeypatch.setattr(Ftdi, "open_mpsse", open_mpsse)
+    monkeypatch.setattr(JtagEngine, "close", lambda self, freeze=False: closed.append(self))
+    with pytest.raises(raised):
+        oscijtag.get_jtag()
+    assert len(closed) == 1
+
+
+@pytest.mark.parametrize(
+    "name, text",
+    [
+        ("OSCIJTAG_FREQUENCY", "fast"),
+        ("OSCIJTAG_FREQUENCY", "0"),
+        ("OSCIJTAG_FREQUENCY", "-1"),
+        ("OSCIJTAG_FREQUENCY", "nan"),
+        ("OSCIJTAG_FREQUENCY", "inf"),
+        ("OSCIJTAG_FREQUENCY", "31e6"),
+        ("OSCIJTAG_CHUNKSIZE", "fast"),
+        ("OSCIJTAG_CHUNKSIZE", "-1"),
+        ("OSCIJTAG_CHUNKSIZE", "2"),
+    ],
+)
+def test_malformed_env(monkeypatch, name, text):
+    monkeypatch.setenv(name, text)
+    # Importing must still succeed; the error is deferred to connecting
+    subprocess.run([sys.executable, "-c", "import oscijtag"], check=True, cwd=pathlib.Path(__file__).resolve().parents[1])
+
+    oscijtag._settings.cache_clear()
+    try:
+        with pytest.raises(ValueError, match=name):
+            oscijtag.get_jtag()
+    finally:
+        oscijtag._settings.cache_clear()
+
+
+@pytest.mark.parametrize("text, chunksize", [("0", 4096), ("64", 64), ("100000", 4096)])
+def test_chunksize_env(ftdi, monkeypatch, text, chunksize):
+    monkeypatch.setenv("OSCIJTAG_CHUNKSIZE", text)
+    oscijtag._settings.cache_clear()
+    try:
+        assert oscijtag._chunk_sizes(ftdi) == (chunksize, chunksize)
+    finally:
+        oscijtag._settings.cache_clear()
+
+
+@pytest.mark.parametrize("text, frequency", [("1e6", 1e6), ("30e6", 30e6)])
+def test_frequency_env(monkeypatch, text, frequency):
+    monkeypatch.setenv("OSCIJTAG_FREQUENCY", text)
+    oscijtag._settings.cache_clear()
+    try:
+        assert oscijtag._settings().frequency == frequency
+    finally:
+        oscijtag._settings.cache_clear()